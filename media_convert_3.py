@@ -41,16 +41,25 @@
 # This is based off of the media-convert script created by Joseph Milazzo
 # https://bitbucket.org/majora2007/media-convert/src/master/
 
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
+import concurrent.futures
+import itertools
+import json
 import os
 import logging
+import multiprocessing
 from pymediainfo import MediaInfo
 import paramiko
 import subprocess
 import signal
 import psutil
+import shlex
+import shutil
+import sqlite3
+import threading
 import time
 import sys
+import uuid
 
 #######################################################################
 #                            Variables                                #
@@ -60,16 +69,21 @@ import sys
 global EXT
 EXT = 'mp4'
 
-# Where to store temporary and log files
+# Where to store log files
 work_dir = '/home/plex/'
 
-# Temporary enconding file
-temp_file = work_dir + 'temp.' + EXT
+# MediaInfo results are cached here, so unchanged files are not parsed again on the next run
+cache_file = work_dir + 'mediainfo.sqlite'
 
 # A list of directories to scan
 watched_folders = ['/home/plex/video']
+# Directories to skip. An absolute path skips that exact directory, a plain name skips every directory called that
 exclude = []
 
+# Directories listed at once during the scan. Listing is mostly waiting on the filesystem, so more
+# workers than cores help, most of all on network shares
+SCAN_WORKERS = 8
+
 # Conditions for video recoding
 MAX_BITRATE = 5000000
 MAX_HEIGHT = 1080
@@ -84,11 +98,39 @@ valid_extensions = ['rmvb', 'mkv', 'avi', 'mov', 'wmv', 'm4v']
 MAX_CHANNELS = 2
 AUDIO_CODEC = "AAC"
 
+# Threads given to each local ffmpeg encode. One encode runs at a time for every ENCODE_THREADS physical cores
+ENCODE_THREADS = 2
+# Upper limit on local encodes running at once, however many cores there are. Each ffmpeg holds its own
+# decode and encode buffers, so memory and disk bandwidth run out before cores do on large machines
+MAX_PARALLEL = 4
+
 # FFMPEG parameters
-ffmpeg_base_cmd = "nice -n 20 ffmpeg -loglevel error -hide_banner -y -i "
-ffmpeg_video_encode = " -c:v libx264 -preset faster -tune zerolatency -profile:v main -pix_fmt yuv420p -crf 23 -b:v 0 -maxrate " + str(MAX_BITRATE) + " -bufsize " + str(int(MAX_BITRATE/2)) + " -vf \"pad=\'ceil(min(" + str(MAX_WIDTH) + ",iw)/2)*2\':\'ceil(min(" + str(MAX_HEIGHT) + ",ih)/2)*2\',scale=\'min(" + str(MAX_WIDTH) + ",iw)\':\'min(" + str(MAX_HEIGHT) + ",ih)\':force_original_aspect_ratio=decrease\""
-ffmpeg_audio_encode = " -c:a aac -ac 2 -b:a 192k"
-ffmpeg_middle_cmd = " -max_muxing_queue_size 1024 -map_metadata -1 -movflags +faststart"
+ffmpeg_base_cmd = ["nice", "-n", "20", "ffmpeg", "-loglevel", "error", "-hide_banner", "-y",
+                   "-filter_threads", str(ENCODE_THREADS), "-filter_complex_threads", str(ENCODE_THREADS)]
+ffmpeg_scale_filter = "pad=\'ceil(min(" + str(MAX_WIDTH) + ",iw)/2)*2\':\'ceil(min(" + str(MAX_HEIGHT) + ",ih)/2)*2\',scale=\'min(" + str(MAX_WIDTH) + ",iw)\':\'min(" + str(MAX_HEIGHT) + ",ih)\':force_original_aspect_ratio=decrease"
+ffmpeg_video_encode = ["-c:v", "libx264", "-threads", str(ENCODE_THREADS), "-preset", "faster",
+                       "-profile:v", "main", "-pix_fmt", "yuv420p", "-crf", "23", "-b:v", "0", "-maxrate", str(MAX_BITRATE),
+                       "-bufsize", str(int(MAX_BITRATE/2)), "-vf", ffmpeg_scale_filter]
+
+# Hardware H.264 encoders tried at startup, in order of preference. The first one that works is used
+# for local encodes instead of libx264. Each entry holds the ffmpeg input options and video options
+HW_ENCODE = True
+ffmpeg_hw_encoders = [
+    ('h264_nvenc', ["-hwaccel", "cuda"],
+     ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-profile:v", "main", "-pix_fmt", "yuv420p", "-rc", "vbr",
+      "-multipass", "fullres", "-cq", "23", "-b:v", "0", "-maxrate", str(MAX_BITRATE), "-bufsize", str(int(MAX_BITRATE/2)),
+      "-vf", ffmpeg_scale_filter]),
+    ('h264_vaapi', ["-hwaccel", "vaapi", "-vaapi_device", "/dev/dri/renderD128"],
+     ["-c:v", "h264_vaapi", "-profile:v", "main", "-rc_mode", "VBR", "-b:v", str(int(MAX_BITRATE/2)),
+      "-maxrate", str(MAX_BITRATE), "-bufsize", str(int(MAX_BITRATE/2)),
+      "-vf", ffmpeg_scale_filter + ",format=nv12,hwupload"]),
+    ('h264_qsv', [],
+     ["-c:v", "h264_qsv", "-preset", "medium", "-profile:v", "main", "-b:v", str(int(MAX_BITRATE/2)),
+      "-maxrate", str(MAX_BITRATE), "-bufsize", str(int(MAX_BITRATE/2)),
+      "-vf", ffmpeg_scale_filter + ",format=nv12"]),
+]
+ffmpeg_audio_encode = ["-c:a", "aac", "-ac", "2", "-b:a", "192k"]
+ffmpeg_middle_cmd = ["-max_muxing_queue_size", "1024", "-map_metadata", "-1", "-movflags", "+faststart"]
 
 # Flag to denote whether to delete source files after successfull encode
 DELETE = True
@@ -113,12 +155,16 @@ ssh_user = "johndoe"
 ssh_password = "supersecret"
 ssh_key = "/path/to/keyfile"
 
+# Number of files handled by the remote host at once. While one is encoded, the others are uploaded or downloaded,
+# so this also limits how many files are stored on the remote folder
+ssh_queue_depth = 2
+
 # This folder must contain the ffmpeg executable and will store the temporary video files. 
 # Use an exclusive folder for this as files may be deleted or overwritten.
 ssh_folder = "C:\\ffmpeg"
 
 ssh_ffmpeg_base_cmd = "ffmpeg.exe -loglevel error -hide_banner -y -i "
-ssh_ffmpeg_video_encode = "-c:v h264_nvenc -preset slow -zerolatency 1 -profile:v main -pix_fmt yuv420p -cq 24 -qmin 23 -qmax 25 -b:v 0 -maxrate " + str(MAX_BITRATE) + " -bufsize " + str(int(MAX_BITRATE/2)) + " -vf \"pad=\'ceil(min(" + str(MAX_WIDTH) + ",iw)/2)*2\':\'ceil(min(" + str(MAX_HEIGHT) + ",ih)/2)*2\',scale=\'min(" + str(MAX_WIDTH) + ",iw)\':\'min(" + str(MAX_HEIGHT) + ",ih)\':force_original_aspect_ratio=decrease\""
+ssh_ffmpeg_video_encode = "-c:v h264_nvenc -preset slow -rc vbr -multipass fullres -profile:v main -pix_fmt yuv420p -cq 24 -qmin 23 -qmax 25 -b:v 0 -maxrate " + str(MAX_BITRATE) + " -bufsize " + str(int(MAX_BITRATE/2)) + " -vf \"pad=\'ceil(min(" + str(MAX_WIDTH) + ",iw)/2)*2\':\'ceil(min(" + str(MAX_HEIGHT) + ",ih)/2)*2\',scale=\'min(" + str(MAX_WIDTH) + ",iw)\':\'min(" + str(MAX_HEIGHT) + ",ih)\':force_original_aspect_ratio=decrease\""
 ssh_ffmpeg_audio_encode = " -c:a aac -ac 2 -b:a 192k"
 ssh_ffmpeg_middle_cmd = " -max_muxing_queue_size 1024 -map_metadata -1 -movflags +faststart"
 
@@ -126,14 +172,63 @@ ssh_ffmpeg_middle_cmd = " -max_muxing_queue_size 1024 -map_metadata -1 -movflags
 #                            Program                                  #
 #######################################################################
 
-# Paths to all valid files
-paths = []
-
 # List of conversions
 commands = []
 
+# Input options for local ffmpeg runs, set when a hardware encoder is used
+ffmpeg_input_cmd = []
+
+# Directory names and (st_dev, st_ino) pairs skipped by the scan, built from exclude at startup
+exclude_names = set()
+exclude_ids = set()
+
+# Set by an encode worker when ffmpeg fails badly enough to stop the whole run
+failed = threading.Event()
+
+# Set by the signal handler on SIGINT/SIGTERM. No new files are started and running ffmpeg processes are ended
+stop_event = threading.Event()
+running = set()
+running_lock = threading.Lock()
+
+# Final names of the files being converted. Sources that only differ in extension, such as Movie.mkv and
+# Movie.avi, convert to the same name, so the second one waits until the first is done
+active_outputs = set()
+active_outputs_cond = threading.Condition()
+
+# Held while ffmpeg runs on the remote host
+remote_encode_lock = threading.Lock()
+
+# Only the MediaInfo fields used below are requested, one line per track
+MEDIAINFO_INFORM = os.linesep.join([
+    'Video;Video|%Format%|%BitRate%|%Format_Profile%|%Height%|%Width%\\n',
+    'Audio;Audio|%Format%|%Channel(s)%\\n',
+    'Text;Text|%CodecID%|%Language%|%ID%\\n',
+])
+
+# Rows added to the MediaInfo cache are written in batches of this size instead of one transaction per file
+CACHE_BATCH = 64
+
+# Statements run against the MediaInfo cache, defined once so the lookup and the batched insert are read
+# and changed in one place
+CACHE_LOOKUP_SQL = 'SELECT tracks FROM mi WHERE path=? AND size=? AND mtime_ns=?'
+CACHE_STORE_SQL = 'INSERT OR REPLACE INTO mi VALUES (?, ?, ?, ?)'
+
+Track = namedtuple('Track', ['track_type', 'format', 'bit_rate', 'format_profile', 'height', 'width',
+                             'channel_s', 'codec_id', 'language', 'track_id'],
+                   defaults=['', None, '', None, None, None, '', '', ''])
+
+# Extensions checked during the scan, lowercased so files are matched whatever the case of their extension
+VALID_EXTS = frozenset('.' + extension.lower() for extension in valid_extensions)
+TARGET_EXT = '.' + EXT
+# Encodes are written next to the source under this suffix and renamed when complete
+PARTIAL_EXT = '.partial' + TARGET_EXT
+
+# Converted files are tagged with this extended attribute so later scans skip them. Where extended
+# attributes are not supported, the file's mtime is pushed past its atime instead
+CONVERTED_XATTR = 'user.media_convert'
+HAS_XATTR = hasattr(os, 'setxattr')
+
 global ssh_client
-global sftp_client
 
 def setup_logger(dir, filename, debug_lvl):
     log_file = filename
@@ -152,60 +247,493 @@ def setup_logger(dir, filename, debug_lvl):
                         format='%(asctime)s %(message)s')
 
 
-def needs_convert(file):
-    for extension in valid_extensions:
-        if file.endswith(extension):
-            logger.warning('Change format: ' + file)
-            return True
-    if file.endswith(EXT):
-        stinfo = os.stat(file)
+def file_ext(name):
+    # Lowercased extension of name including the dot, '' when there is none
+    dot = name.rfind('.')
+    if dot == -1:
+        return ''
+    return name[dot:].lower()
+
+
+def needs_convert(path, stinfo):
+    ext = file_ext(path)
+    if ext in VALID_EXTS:
+        logger.warning('Change format: %s', path)
+        return True
+    if ext == TARGET_EXT:
+        # Files tagged with CONVERTED_XATTR never get here. This catches files converted before the
+        # attribute was used, or on filesystems without it
         if stinfo.st_mtime > stinfo.st_atime:
-            logger.debug('Ignore: ' + file)
+            logger.debug('Ignore: %s', path)
             return False
-        logger.warning('Recode: ' + file)
+        logger.warning('Recode: %s', path)
         return True
     return False
 
 
-def normalize_path(path):
-    return path.replace('\\', '/')
+def is_converted(path):
+    if not HAS_XATTR:
+        return False
+    try:
+        os.getxattr(path, CONVERTED_XATTR)
+    except OSError:
+        return False
+    return True
+
+
+def mark_converted(path):
+    if HAS_XATTR:
+        try:
+            os.setxattr(path, CONVERTED_XATTR, b'1')
+            return
+        except OSError:
+            pass
+    stinfo = os.stat(path)
+    os.utime(path, (stinfo.st_atime, stinfo.st_mtime+157680000))
+
+
+def list_dir(path):
+    # Runs in a scan worker. Returns the subdirectories of path to descend into and its candidate files
+    # as (path, stat) pairs. Only files already in the target format are stat'ed, since only their
+    # timestamps are checked; files changing format get None. Files tagged as converted are dropped
+    # before the stat
+    dirs = []
+    files = []
+    # Checked once per directory, as converted files are the bulk of a library
+    log_ignored = logger.isEnabledFor(logging.DEBUG)
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        logger.exception('There was an issue scanning %s', path)
+        return dirs, files
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in exclude_names:
+                    continue
+                # Directories are only stat'ed when an absolute path is excluded
+                if exclude_ids:
+                    dirinfo = entry.stat(follow_symlinks=False)
+                    if (dirinfo.st_dev, dirinfo.st_ino) in exclude_ids:
+                        continue
+                dirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                ext = file_ext(entry.name)
+                if ext in VALID_EXTS:
+                    files.append((entry.path, None))
+                elif ext == TARGET_EXT and not entry.name.lower().endswith(PARTIAL_EXT):
+                    if is_converted(entry.path):
+                        if log_ignored:
+                            logger.debug('Ignore: %s', entry.path)
+                        continue
+                    files.append((entry.path, entry.stat()))
+    return dirs, files
+
+
+def iter_files(base, scanner):
+    # Walks base, listing up to 2 * SCAN_WORKERS directories at once on the scanner pool, and yields
+    # the candidate files of each directory as soon as it is listed. Directories still to be listed wait
+    # in a queue, so a slow consumer never holds more than a few listings in memory
+    dirs = deque([base])
+    pending = set()
+    while dirs or pending:
+        while dirs and len(pending) < 2 * SCAN_WORKERS:
+            pending.add(scanner.submit(list_dir, dirs.popleft()))
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            subdirs, files = future.result()
+            dirs.extend(subdirs)
+            yield from files
+
+
+def scan_files():
+    # Yields (path, stat) for each file that needs converting as soon as it is found,
+    # so conversions start while the rest of the library is still being scanned
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_WORKERS) as scanner:
+        for base_path in watched_folders:
+            base_path = normalize_path(base_path)
+            logger.info('Searching for files in %s', base_path)
+            for path, stinfo in iter_files(base_path, scanner):
+                if needs_convert(path, stinfo):
+                    count += 1
+                    yield normalize_path(path), stinfo
+    logger.info('=====Scan Complete=====')
+    logger.info('Total files scanned: %s', count)
+
+
+def to_int(value):
+    value = value.split(' / ')[0]
+    if value.isdigit():
+        return int(value)
+    return None
+
+
+def parse_tracks(path):
+    # Runs in a worker process
+    tracks = []
+    output = MediaInfo.parse(path, full=False, output=MEDIAINFO_INFORM)
+    for line in output.splitlines():
+        fields = line.split('|')
+        if fields[0] == 'Video':
+            tracks.append(Track('Video', format=fields[1], bit_rate=to_int(fields[2]), format_profile=fields[3],
+                                height=to_int(fields[4]), width=to_int(fields[5])))
+        elif fields[0] == 'Audio':
+            tracks.append(Track('Audio', format=fields[1], channel_s=to_int(fields[2])))
+        elif fields[0] == 'Text':
+            tracks.append(Track('Text', codec_id=fields[1], language=fields[2], track_id=fields[3]))
+    return tracks
+
+
+def open_cache(path):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('CREATE TABLE IF NOT EXISTS mi (path TEXT PRIMARY KEY, size INT, mtime_ns INT, tracks TEXT)')
+    # Refresh planner statistics when they are stale. analysis_limit keeps this quick on a large cache
+    conn.execute('PRAGMA analysis_limit=1000')
+    conn.execute('PRAGMA optimize')
+    return conn
+
+
+def close_cache(conn):
+    conn.execute('PRAGMA optimize')
+    conn.close()
+
+
+def cache_lookup(conn, path, stinfo):
+    row = conn.execute(CACHE_LOOKUP_SQL, (path, stinfo.st_size, stinfo.st_mtime_ns)).fetchone()
+    if row is None:
+        return None
+    return [Track(*track) for track in json.loads(row[0])]
+
+
+def cache_store(rows, path, stinfo, tracks):
+    # Only queues the row, cache_flush writes the queued rows in one transaction
+    rows.append((path, stinfo.st_size, stinfo.st_mtime_ns, json.dumps(tracks)))
+
+
+def cache_flush(conn, rows):
+    with conn:
+        conn.executemany(CACHE_STORE_SQL, rows)
+    rows.clear()
+
+
+def plan_conversion(tracks):
+    # Work out which ffmpeg options and subtitle extractions a file needs
+    plan = {'encode_video': False, 'encode_audio': False, 'sub_jobs': []}
+    for track in tracks or []:
+        if track.track_type == 'Video':
+            if not track.bit_rate:
+                plan['encode_video'] = True
+            elif not track.format.startswith(VIDEO_CODEC) or track.bit_rate > MAX_BITRATE or track.height > MAX_HEIGHT or track.width > MAX_WIDTH:
+                plan['encode_video'] = True
+            elif track.height % 2 or track.width %2:
+                plan['encode_video'] = True
+            elif track.format.startswith(VIDEO_CODEC) and not track.format_profile.startswith(VIDEO_PROFILE):
+                plan['encode_video'] = True
+        elif track.track_type == 'Audio':
+            if track.channel_s > MAX_CHANNELS or not track.format.startswith(AUDIO_CODEC):
+                plan['encode_audio'] = True
+        elif track.track_type == 'Text' and track.codec_id and track.codec_id.startswith('S_TEXT'):
+            subname = str(track.track_id)
+            if track.language:
+                subname = track.language
+            plan['sub_jobs'].append((track.track_id, subname))
+    return plan
+
+
+# Paths only need their separators rewritten on Windows. Elsewhere a backslash is a valid character in a
+# file name, so paths are left untouched
+if os.sep == '\\':
+    def normalize_path(path):
+        return path.replace('\\', '/')
+else:
+    def normalize_path(path):
+        return path
 
 
 def to_mp4_naming(filename):
-    parts = filename.split('.')
-    parts[len(parts)-1] = EXT
-    output_path = '.'.join(parts)
-    return output_path
+    root, ext = os.path.splitext(filename)
+    # Keep the name of files already in the target format, so 'Movie.MP4' is not renamed to 'Movie.mp4',
+    # which is the same file on case-insensitive filesystems
+    if ext.lower() == TARGET_EXT:
+        return filename
+    return root + TARGET_EXT
 
 
 def delete(path):
     logger = logging.getLogger(__name__)
-    logger.info('Deleting ' + path)
+    logger.info('Deleting %s', path)
     try:
         os.remove(path)
     except OSError:
-        logger.exception('There was an issue deleting ' + path)
+        logger.exception('There was an issue deleting %s', path)
+
+def remove_outputs(paths):
+    # Removes what an unfinished ffmpeg run left behind, so truncated files do not stay next to the source
+    for path in paths:
+        if os.path.isfile(path):
+            delete(path)
+
+def open_remote():
+    sftp = ssh_client.open_sftp()
+    sftp.chdir(ssh_folder)
+    return sftp
 
-def remote_delete(path):
+def remote_delete(sftp, path, missing_ok=False):
     logger = logging.getLogger(__name__)
-    logger.info('Deleting on remote folder: ' + path)
+    logger.info('Deleting on remote folder: %s', path)
     try:
-        sftp_client.remove(path)
+        sftp.remove(path)
+    except FileNotFoundError:
+        if not missing_ok:
+            logger.exception('There was an issue deleting %s', path)
     except IOError:
-        logger.exception('There was an issue deleting ' + path)
+        logger.exception('There was an issue deleting %s', path)
+
+def upload(sftp, local_path, remote_path):
+    # Pipelined writes do not wait for each SFTP write to be acknowledged. The local file is read in 1 MiB blocks
+    with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        shutil.copyfileobj(local_file, remote_file, 1 << 20)
 
 def move(file_from, file_to):
     logger = logging.getLogger(__name__)
-    logger.info('Moving ' + file_from + ' to ' + file_to)
+    logger.info('Moving %s to %s', file_from, file_to)
     try:
-        os.rename(file_from, file_to)
+        os.replace(file_from, file_to)
     except OSError:
-        logger.exception('There was an issue moving ' +
-                         file_from + ' to ' + file_to)
+        logger.exception('There was an issue moving %s to %s', file_from, file_to)
+        return False
+    return True
+
+
+def output_names(cur_file):
+    # Returns the final name for a converted file and the .partial name ffmpeg writes to.
+    # Both sit in the source's directory, so the final rename never copies data across filesystems.
+    # The partial name keeps the source extension, so it is never shared with another source
+    final_file = to_mp4_naming(cur_file)
+    if not DELETE and cur_file == final_file:
+        final_file = to_mp4_naming(cur_file + ".new")
+    return final_file, cur_file + PARTIAL_EXT
+
+
+def finish_file(cur_file, final_file, partial_file):
+    # Renames a completed encode over its final name. The source is only removed once that succeeded
+    mark_converted(partial_file)
+    if not move(partial_file, final_file):
+        return
+    if DELETE and cur_file != final_file:
+        delete(cur_file)
+
+
+def cmd_line(cmd):
+    return ' '.join(shlex.quote(arg) for arg in cmd)
+
+
+def run_ffmpeg(cmd):
+    # ffmpeg only writes errors to stderr (-loglevel error); log them line by line as they arrive.
+    # stdin is closed, since several ffmpeg runs at once would otherwise all read from and reconfigure the
+    # terminal, and an overwrite prompt would wait forever
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         universal_newlines=True, errors='replace')
+    with running_lock:
+        running.add(p)
+    try:
+        if stop_event.is_set():
+            p.terminate()
+        for line in p.stderr:
+            if line.strip():
+                logger.error(line.rstrip())
+        p.stderr.close()
+        return p.wait()
+    finally:
+        with running_lock:
+            running.discard(p)
+
+
+def detect_hw_encoder():
+    # Returns the first entry of ffmpeg_hw_encoders that ffmpeg lists and can actually encode a test frame with
+    try:
+        p = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        return None
+    for encoder in ffmpeg_hw_encoders:
+        name, input_cmd, video_cmd = encoder
+        if (' ' + name + ' ') not in p.stdout:
+            continue
+        test_cmd = (["ffmpeg", "-loglevel", "error", "-hide_banner"] + input_cmd +
+                    ["-f", "lavfi", "-i", "color=black:s=256x256:d=1", "-frames:v", "1"] + video_cmd + ["-an", "-f", "null", "-"])
+        if subprocess.call(test_cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+            return encoder
+    return None
 
 
 def signal_handler(signum, frame):
-    pass
+    if stop_event.is_set():
+        return
+    logger.warning('Received signal %s, stopping', signum)
+    stop_event.set()
+    with running_lock:
+        for p in running:
+            p.terminate()
+
+
+def convert_file(cur_file, plan):
+    # Runs in an encode worker thread. Fatal ffmpeg errors set failed, so no further files are started
+    final_file, partial_file = output_names(cur_file)
+    with active_outputs_cond:
+        while final_file in active_outputs:
+            active_outputs_cond.wait()
+        active_outputs.add(final_file)
+    try:
+        run_conversion(cur_file, plan, final_file, partial_file)
+    finally:
+        with active_outputs_cond:
+            active_outputs.discard(final_file)
+            active_outputs_cond.notify_all()
+
+
+def run_conversion(cur_file, plan, final_file, partial_file):
+    if failed.is_set() or stop_event.is_set():
+        return
+    if os.path.isfile(partial_file):
+        delete(partial_file)
+    ffmpeg_cmd = ffmpeg_base_cmd + ffmpeg_input_cmd + ["-i", cur_file]
+    video_cmd = ["-c:v", "copy"]
+    audio_cmd = ["-c:a", "copy"]
+    need_remote = plan['encode_video']
+    redo_audio = plan['encode_audio']
+    if need_remote:
+        video_cmd = ffmpeg_video_encode
+    if redo_audio:
+        audio_cmd = ffmpeg_audio_encode
+    # Subtitles are written by the same ffmpeg run that converts the file, so the input is only read once
+    # Free subtitle names are picked against one listing of the directory instead of a stat per candidate
+    sub_outputs = []
+    subfiles = []
+    if plan['sub_jobs']:
+        dirname, base = os.path.split(os.path.splitext(cur_file)[0])
+        existing = set(os.listdir(dirname or '.'))
+    for track_id, subname in plan['sub_jobs']:
+        subname = base + '.' + subname
+        name = subname + '.srt'
+        subcount = 1
+        while name in existing:
+            name = subname + str(subcount) + '.srt'
+            subcount = subcount + 1
+        existing.add(name)
+        subfile = os.path.join(dirname, name)
+        logger.info('Extracting subtitle: %s', subfile)
+        subfiles.append(subfile)
+        sub_outputs += ["-map", "0:" + str(int(track_id)-1), "-c:s", "srt", subfile]
+    if need_remote == True and ssh_enabled == True and JUST_CHECK == False:
+        if sub_outputs:
+            # Only the video is encoded remotely, so subtitles are extracted here in a single ffmpeg run
+            sub_cmd = ["ffmpeg", "-loglevel", "error", "-hide_banner", "-i", cur_file] + sub_outputs
+            retval = run_ffmpeg(sub_cmd)
+            if retval != 0:
+                remove_outputs(subfiles)
+            if stop_event.is_set() and retval != 0:
+                return
+            if retval < -1 or retval > 10:
+                logger.error('Error: ffmpeg process killed, exiting')
+                failed.set()
+                return
+        # Each remote job has its own SFTP session and file names, so the upload of one file and the
+        # download of another overlap with the remote encode. Only the encode itself is serialized
+        job_id = uuid.uuid4().hex
+        in_file = "in." + job_id + os.path.splitext(cur_file)[1]
+        out_file = "out." + job_id + TARGET_EXT
+        sftp = open_remote()
+        converted = False
+        try:
+            logger.info("Sending file: %s", cur_file)
+            try:
+                upload(sftp, cur_file, in_file)
+            except IOError:
+                logger.exception("Error sending file %s", cur_file)
+                remote_delete(sftp, in_file)
+                return
+            logger.info("File sent successfully")
+            # A remote encode cannot be interrupted, so it is not started once a stop was requested
+            if stop_event.is_set():
+                remote_delete(sftp, in_file)
+                return
+            video_cmd = ssh_ffmpeg_video_encode
+            audio_cmd = " -c:a copy"
+            if redo_audio:
+                audio_cmd = ssh_ffmpeg_audio_encode
+            ffmpeg_cmd = ssh_folder + "\\" + ssh_ffmpeg_base_cmd + "\"" + ssh_folder + "\\" + in_file + "\" " + video_cmd + audio_cmd + ssh_ffmpeg_middle_cmd + " \"" + ssh_folder + "\\" + out_file + "\""
+            logger.debug("Full command: %s", ffmpeg_cmd)
+            retval = -2
+            try:
+                with remote_encode_lock:
+                    try:
+                        stdin, stdout, stderr = ssh_client.exec_command(ffmpeg_cmd)
+                        for line in stderr:
+                            logger.error(line.rstrip())
+                        retval = stdout.channel.recv_exit_status()
+                    except Exception as e:
+                        logger.error("Error running remote command: %s", e)
+                remote_delete(sftp, in_file)
+                if retval == 0:
+                    logger.info('File processed successfully')
+                    try:
+                        sftp.get(out_file, partial_file)
+                    except IOError:
+                        logger.error("Error downloading processed file")
+                        if os.path.isfile(partial_file):
+                            delete(partial_file)
+                        failed.set()
+                        return
+                    finish_file(cur_file, final_file, partial_file)
+                    converted = True
+                if retval < -1 or retval > 10:
+                    logger.error('Error: ffmpeg process failed remotely, exiting')
+                    failed.set()
+                    return
+            finally:
+                # A failed or interrupted encode can leave a partial output, and a failed download leaves
+                # the whole one. It is always removed, so at most ssh_queue_depth files stay on the remote folder
+                remote_delete(sftp, out_file, missing_ok=True)
+        finally:
+            sftp.close()
+            # Subtitles extracted for a file whose encode did not finish would be extracted again,
+            # under new names, on the next run
+            if not converted:
+                remove_outputs(subfiles)
+    else:
+        ffmpeg_cmd = ffmpeg_cmd + video_cmd + audio_cmd + ffmpeg_middle_cmd + [partial_file] + sub_outputs
+
+        if JUST_CHECK:
+            commands.append(cmd_line(ffmpeg_cmd))
+        else:
+            logger.warning('Encoding %s', cur_file)
+            # Quoting the command line is only worth it when it is actually logged
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(cmd_line(ffmpeg_cmd))
+            retval = run_ffmpeg(ffmpeg_cmd)
+            if stop_event.is_set() and retval != 0:
+                # Ended by the signal handler, which is not an ffmpeg failure
+                logger.warning('Stopped encoding %s', cur_file)
+                remove_outputs([partial_file] + subfiles)
+                return
+            logger.debug('Convert returned: %s', retval)
+            if retval == 0:
+                logger.info('File processed successfully')
+                finish_file(cur_file, final_file, partial_file)
+            else:
+                remove_outputs([partial_file] + subfiles)
+            if retval < -1 or retval > 10:
+                logger.error('Error: ffmpeg process killed, exiting')
+                failed.set()
+                return
 
 
 if __name__ == '__main__':
@@ -214,193 +742,169 @@ if __name__ == '__main__':
     # Register signals, such as CTRL + Cf
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
-    logger.info("######### Script Executed at " +
-                time.asctime(time.localtime(time.time())))
+    logger.info("######### Script Executed at %s", time.asctime(time.localtime(time.time())))
+
+    # Without MediaInfo no file can be checked, and converting files blindly would remux and tag them as done.
+    # Whether libmediainfo can be loaded does not change during the run, so it is only checked once
+    if not MediaInfo.can_parse():
+        logger.error('MediaInfo library not available, exiting')
+        sys.exit(1)
     
     t0 = time.time()
 
-    for base_path in watched_folders:
-        base_path = normalize_path(base_path)
-        logger.info('Searching for files in ' + base_path)
-        t0 = time.time()
-        for root, dirs, files in os.walk(base_path, topdown=True):
-            dirs[:] = [d for d in dirs if d not in exclude]
-            for file in files:
-                if needs_convert(os.path.join(root, file)):
-                    path = os.path.join(root, file)
-                    paths.append(normalize_path(path))
-        t1 = time.time()
-        logger.info('[Directory Scan] Execution took %s seconds' % str(round(t1-t0,0)))
-    logger.info('=====Scan Complete=====')
-    logger.info('Total files scanned: ' + str(len(paths)))
+    if HW_ENCODE:
+        hw_encoder = detect_hw_encoder()
+        if hw_encoder:
+            logger.info('Using hardware encoder %s', hw_encoder[0])
+            ffmpeg_input_cmd = hw_encoder[1]
+            ffmpeg_video_encode = hw_encoder[2]
+        else:
+            logger.info('No hardware encoder available, using libx264')
 
-    if len(paths) > 0:
+    for path in exclude:
+        if not os.path.isabs(path):
+            exclude_names.add(path)
+            continue
+        try:
+            stinfo = os.stat(path)
+        except OSError:
+            logger.warning('Excluded directory not found: %s', path)
+            continue
+        exclude_ids.add((stinfo.st_dev, stinfo.st_ino))
+
+    # The SSH session is only opened once the scan finds a first file
+    pending = scan_files()
+    first = next(pending, None)
+    if first is not None:
         logger.info('Converting...')
+        pending = itertools.chain([first], pending)
     
-    if ssh_enabled == True and len(paths) > 0:
+    if ssh_enabled == True and first is not None:
         ssh_client = paramiko.SSHClient()
         ssh_client.load_system_host_keys()
         try:
             ssh_client.connect(ssh_host, username=ssh_user, password=ssh_password, key_filename=ssh_key)
         except Exception as e:
-            logger.error("SSH Error: " + str(e))
+            logger.error("SSH Error: %s", e)
             ssh_enabled = False
         if ssh_enabled:
+            # Larger windows for the SFTP channel keep gigabit links busy when sending multi-GB files
+            transport = ssh_client.get_transport()
+            transport.default_window_size = 2**27
+            transport.default_max_packet_size = 2**19
+            transport.set_keepalive(30)
             try:
                 sftp_client = ssh_client.open_sftp()
             except Exception as e:
-                logger.error("Error opening SFTP session: " + str(e))
+                logger.error("Error opening SFTP session: %s", e)
                 ssh_enabled = False
         if ssh_enabled:
+            # Each remote job opens its own SFTP session, so this one is only used to check the folder
             try:
                 sftp_client.chdir(ssh_folder)
             except IOError:
                 logger.error("Invalid SFTP folder")
                 ssh_client.close()
                 ssh_enabled = False
+            finally:
+                sftp_client.close()
         if ssh_enabled:
-            logger.info("SSH and SFTP sessions created successfully")
+            logger.info("SSH session created and SFTP folder checked successfully")
         else:
             logger.warning("Disabling remote recoding due to SSH error")
     
+    # Parse the next files with MediaInfo while the current one is being encoded.
+    # Files whose size and mtime match the cache are not parsed at all
+    cache = open_cache(cache_file)
+    parse_workers = psutil.cpu_count(logical=False) or 1
+    # Parse workers are started fresh instead of forked, since by now this process runs scan threads and
+    # has the cache database open, and a fork copies locks held by other threads in whatever state they are.
+    # Ctrl-C reaches the whole process group, so workers ignore SIGINT and leave the stop to this process
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=signal.signal,
+                                                      initargs=(signal.SIGINT, signal.SIG_IGN))
+    # Files are parsed up to parse_ahead files before they are handed to the encoders
+    parse_ahead = 2 * parse_workers
+    jobs = deque()
+    scan_done = False
+
+    # Encode several files at once, each ffmpeg using ENCODE_THREADS threads. Only a few files are
+    # queued beyond the running encodes, so the scan never gets far ahead of them
+    encode_workers = max(1, min(MAX_PARALLEL, (psutil.cpu_count(logical=False) or 1) // ENCODE_THREADS))
+    encoder = concurrent.futures.ThreadPoolExecutor(max_workers=encode_workers)
+    max_queued = 2 * encode_workers
+    remote_encoder = None
+    if ssh_enabled and first is not None:
+        remote_encoder = concurrent.futures.ThreadPoolExecutor(max_workers=ssh_queue_depth)
+        max_queued += 2 * ssh_queue_depth
+    encodes = set()
+
     count = 0.0
-    for path in paths:
+    cache_rows = []
+    while not failed.is_set() and not stop_event.is_set():
+        while not scan_done and len(jobs) < parse_ahead:
+            item = next(pending, None)
+            if item is None:
+                scan_done = True
+                break
+            path, stinfo = item
+            # Files changing format were not stat'ed during the scan
+            if stinfo is None:
+                stinfo = os.stat(path)
+            tracks = cache_lookup(cache, path, stinfo)
+            future = None
+            if tracks is None:
+                future = executor.submit(parse_tracks, path)
+            jobs.append((path, stinfo, tracks, future))
+        if not jobs:
+            break
+        path, stinfo, tracks, future = jobs.popleft()
         count += 1.0
-        cur_file = normalize_path(path)
-        ffmpeg_cmd = ffmpeg_base_cmd + "\"" + cur_file + "\""
-        video_cmd = ' -c:v copy'
-        audio_cmd = ' -c:a copy'
-        need_remote = False
-        redo_audio = False
-        media_info = MediaInfo.parse(normalize_path(path))
-        if MediaInfo.can_parse():
-            for track in media_info.tracks:
-                if track.track_type == 'Video':
-                    if not track.bit_rate:
-                        video_cmd = ffmpeg_video_encode
-                        need_remote = True
-                    elif not track.format.startswith(VIDEO_CODEC) or track.bit_rate > MAX_BITRATE or track.height > MAX_HEIGHT or track.width > MAX_WIDTH:
-                        video_cmd = ffmpeg_video_encode
-                        need_remote = True
-                    elif track.height % 2 or track.width %2:
-                        video_cmd = ffmpeg_video_encode
-                        need_remote = True
-                    elif track.format.startswith(VIDEO_CODEC) and not track.format_profile.startswith(VIDEO_PROFILE):
-                        video_cmd = ffmpeg_video_encode
-                        need_remote = True
-                elif track.track_type == 'Audio':
-                    if track.channel_s > MAX_CHANNELS or not track.format.startswith(AUDIO_CODEC):
-                        redo_audio = True
-                        audio_cmd = ffmpeg_audio_encode
-                elif track.track_type == 'Text' and track.codec_id and track.codec_id.startswith('S_TEXT'):
-                    subname = str(track.track_id)
-                    if track.language:
-                        subname = track.language
-                    parts = cur_file.split('.')
-                    parts[len(parts)-1] = subname
-                    subcount = 1
-                    while os.path.isfile('.'.join(parts) + ".srt"):
-                        parts[len(parts)-1] = subname + str(subcount)
-                        subcount = subcount + 1
-                    subfile = '.'.join(parts) + ".srt"
-                    logger.info('Extracting subtitle: ' + subfile)
-                    sub_cmd = "ffmpeg -loglevel error -hide_banner -i \"" + cur_file + "\" -map 0:" + str(int(track.track_id)-1) + " \"" + subfile + "\""
-                    p = subprocess.Popen(sub_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    for line in p.stdout.readlines():
-                        logger.error(line)
-                    retval = p.wait()
-                    if retval < -1 or retval > 10:
-                        logger.error('Error: ffmpeg process killed, exiting')
-                        sys.exit(1)
-        if need_remote == True and ssh_enabled == True and JUST_CHECK == False:
-            parts = cur_file.split('.')
-            in_file = "in." + parts[len(parts)-1]
-            out_file = "out." + EXT
-            remote_infile = True
+        if future:
+            if stop_event.is_set():
+                break
             try:
-                sftp_client.lstat(in_file)
-            except IOError:
-                remote_infile = False
-            if remote_infile:
-                remote_delete(in_file)
-            logger.info("Sending file: " + cur_file)
-            remote_infile = sftp_client.put(cur_file, in_file)
-            if remote_infile:
-                logger.info("File sent successfully")
-            video_cmd = ssh_ffmpeg_video_encode
-            if redo_audio:
-                audio_cmd = ssh_ffmpeg_audio_encode
-            ffmpeg_cmd = ssh_folder + "\\" + ssh_ffmpeg_base_cmd + "\"" + ssh_folder + "\\" + in_file + "\" " + video_cmd + audio_cmd + ssh_ffmpeg_middle_cmd + " \"" + ssh_folder + "\\" + out_file + "\""
-            logger.debug("Full command: " + ffmpeg_cmd)
-            try:
-                stdin, stdout, stderr = ssh_client.exec_command(ffmpeg_cmd)
-                retval = stdout.channel.recv_exit_status()
-            except Exception as e:
-                logger.error("Error running remote command: " + str(e))
-            for line in stdout.readlines():
-                logger.error(line)
-            if retval == 0:
-                logger.info('File processed successfully')
-                if os.path.isfile(temp_file):
-                    delete(temp_file)
-                try:
-                    sftp_client.get(out_file,temp_file)
-                except IOError:
-                    logger.error("Error downloading processed file")
-                    ssh_client.close()
-                    sys.exit(1)
-                remote_delete(in_file)
-                remote_delete(out_file)
-                if DELETE:
-                    delete(cur_file)
-                    cur_file = to_mp4_naming(cur_file)
-                    move(temp_file, cur_file)
-                else:
-                    if cur_file == to_mp4_naming(cur_file):
-                        cur_file = cur_file + ".new"
-                    cur_file = to_mp4_naming(cur_file)
-                    move(temp_file, cur_file)
-                stinfo = os.stat(cur_file)
-                os.utime(cur_file, (stinfo.st_atime, stinfo.st_mtime+157680000))
-            if retval < -1 or retval > 10:
-                logger.error('Error: ffmpeg process failed remotely, exiting')
-                ssh_client.close()
-                sys.exit(1)
+                tracks = future.result()
+            except concurrent.futures.BrokenExecutor:
+                # Workers also receive the SIGTERM of a service stop, which is handled like any other stop
+                if not stop_event.is_set():
+                    logger.error('MediaInfo worker ended unexpectedly, exiting')
+                    failed.set()
+                break
+            except Exception:
+                logger.exception('MediaInfo failed on %s', path)
+                continue
+            if tracks is not None:
+                cache_store(cache_rows, path, stinfo, tracks)
+                if len(cache_rows) >= CACHE_BATCH:
+                    cache_flush(cache, cache_rows)
+        plan = plan_conversion(tracks)
+        while len(encodes) >= max_queued:
+            done, encodes = concurrent.futures.wait(encodes, return_when=concurrent.futures.FIRST_COMPLETED)
+            for encode in done:
+                encode.result()
+        if plan['encode_video'] and remote_encoder and not JUST_CHECK:
+            encodes.add(remote_encoder.submit(convert_file, path, plan))
         else:
-            ffmpeg_cmd = ffmpeg_cmd + video_cmd + audio_cmd + ffmpeg_middle_cmd + " \"" + temp_file + "\""
-
-            if JUST_CHECK:
-                commands.append(ffmpeg_cmd)
-            else:
-                if os.path.isfile(temp_file):
-                    delete(temp_file)
-                logger.warning('Encoding ' + cur_file)
-                logger.debug(ffmpeg_cmd)
-                p = subprocess.Popen(
-                    ffmpeg_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                for line in p.stdout.readlines():
-                    logger.error(line)
-                retval = p.wait()
-                logger.debug('Convert returned: ' + str(retval))
-                if retval == 0:
-                    logger.info('File processed successfully')
-                    if DELETE:
-                        delete(cur_file)
-                        cur_file = to_mp4_naming(cur_file)
-                        move(temp_file, cur_file)
-                    else:
-                        if cur_file == to_mp4_naming(cur_file):
-                            cur_file = cur_file + ".new"
-                        cur_file = to_mp4_naming(cur_file)
-                        move(temp_file, cur_file)
-                    stinfo = os.stat(cur_file)
-                    os.utime(cur_file, (stinfo.st_atime, stinfo.st_mtime+157680000))
-                if retval < -1 or retval > 10:
-                    logger.error('Error: ffmpeg process killed, exiting')
-                    sys.exit(1)
+            encodes.add(encoder.submit(convert_file, path, plan))
+
+    for encode in encodes:
+        encode.result()
+    encoder.shutdown()
+    if remote_encoder:
+        remote_encoder.shutdown()
+    executor.shutdown(wait=False, cancel_futures=True)
+    cache_flush(cache, cache_rows)
+    close_cache(cache)
+    if ssh_enabled and first is not None:
+        ssh_client.close()
+
+    if failed.is_set() or stop_event.is_set():
+        sys.exit(1)
 
     t1 = time.time()
-    logger.info('[Media Check] Execution took %s s' % str(round(t1-t0,1)))
+    logger.info('[Media Check] Execution took %s s', round(t1-t0,1))
 
     if JUST_CHECK:
         for cmd in commands: